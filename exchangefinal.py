@@ -4,35 +4,75 @@ import pandas as pd
 import numpy as np
 import random
 import networkx as nx
+from numba import njit, types
+from numba.typed import List
 import datetime
 import time
+import os
+from concurrent.futures import ThreadPoolExecutor
+import logging
 from io import BytesIO
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne
+from pymongo.errors import DuplicateKeyError
 import uuid
+import hashlib
+from collections import defaultdict
+
+def ensure_agency_index(collection):
+    # A non-unique fallback from an earlier start would clash with the unique
+    # index on the same key, so drop it and retry the unique build each time.
+    for index_name, spec in collection.index_information().items():
+        if spec['key'] == [('agency_id', 1)] and not spec.get('unique'):
+            collection.drop_index(index_name)
+    try:
+        collection.create_index("agency_id", unique=True)
+    except DuplicateKeyError:
+        # Older upserts could race and leave duplicate agency_id documents;
+        # keep the app running with a plain index until they are merged.
+        logging.getLogger(__name__).warning(
+            "Duplicate agency_id documents found; creating a non-unique agency_id index.")
+        collection.create_index("agency_id", name="agency_id_nonunique")
 
 @st.cache_resource
 def get_mongo_collection():
     client = MongoClient(st.secrets["mongo"]["uri"])
     db = client.car_exchange
     collection = db.user_uploads
+    ensure_agency_index(collection)
+    collection.create_index("uploads.uploaded_at")
+    for items in (db.offers, db.wants):
+        items.create_index("upload_id")
+        items.create_index([("agency_id", 1), ("_fn", 1)])
     return collection
 
 mongo_collection = get_mongo_collection() if "mongo" in st.secrets else None
 
-def load_offer_want_excel(file):
-    xls = pd.ExcelFile(file)
+@st.cache_data(ttl=600, max_entries=16)
+def load_offer_want_excel(file_bytes):
+    xls = pd.ExcelFile(BytesIO(file_bytes), engine='calamine')
     offers = pd.read_excel(xls, 'Offers')
     wants = pd.read_excel(xls, 'Wants')
     return offers.to_dict('records'), wants.to_dict('records')
 
 def save_user_data_to_mongo(offers, wants, name, agency_id):
+    upload_id = str(uuid.uuid4())
+    db = mongo_collection.database
+    # Offers and wants live in their own collections so a large upload is
+    # written in batches instead of as one ever-growing user document.
+    stored = []
+    for collection, items in ((db.offers, offers), (db.wants, wants)):
+        ops = [InsertOne({**item, "agency_id": agency_id, "upload_id": upload_id})
+               for item in normalize_items(items)]
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+        stored.append(len(ops))
+
     mongo_collection.update_one(
         {"agency_id": agency_id},
         {
             "$push": {
                 "uploads": {
-                    "offers": offers,
-                    "wants": wants,
+                    "upload_id": upload_id,
                     "uploaded_at": datetime.datetime.now()
                 }
             },
@@ -44,100 +84,244 @@ def save_user_data_to_mongo(offers, wants, name, agency_id):
         },
         upsert=True
     )
+    return tuple(stored)
+
+# _fn key -> dense int id, so matching compares ints instead of strings
+FN_INTERN = {}
+
+def intern_full_name(fn):
+    return FN_INTERN.setdefault(fn, len(FN_INTERN))
+
+def name_part(values):
+    # A numeric column with blank cells is read as float64; without this,
+    # 2020 would format as "2020.0" and miss uploads that have no blanks.
+    values = pd.Series([int(v) if isinstance(v, float) and v.is_integer() else v for v in values],
+                       index=values.index, dtype=object)
+    return values.astype(str).str.strip()
+
+def normalize_items(items):
+    if not items:
+        return items
+    df = pd.DataFrame(items)
+    full_name = df['full_name'] if 'full_name' in df else pd.Series(None, index=df.index, dtype=object)
+    if 'MODELO' in df and 'VERSION' in df:
+        computed = (name_part(df['MODELO']) + " - " + name_part(df['VERSION'])).str.upper()
+        full_name = full_name.fillna(computed.where(df['MODELO'].notna() & df['VERSION'].notna()))
+    fn = full_name.astype(str).str.strip().str.lower().where(full_name.notna())
+    # Rows without a name (e.g. blank MODELO/VERSION cells) are dropped; they
+    # would otherwise all share the same NaN key and match each other.
+    return [{**item, 'full_name': name, '_fn': key}
+            for item, name, key in zip(items, full_name, fn)
+            if isinstance(key, str) and key]
+
+def load_upload_items(field, upload_ids, batch_size=1000):
+    items = defaultdict(list)
+    collection = mongo_collection.database[field]
+    for begin in range(0, len(upload_ids), batch_size):
+        cursor = collection.find({"upload_id": {"$in": upload_ids[begin:begin + batch_size]}},
+                                 {"_id": 0}, batch_size=batch_size)
+        for item in cursor:
+            items[item['upload_id']].append(item)
+    return items
 
 def load_all_requests_from_mongo():
     requests = []
-    participants = list(mongo_collection.find({}))
-    for user in participants:
-        for upload in user.get("uploads", []):
-            offers = upload.get('offers', [])
-            wants = upload.get('wants', [])
-            for offer in offers:
-                if 'full_name' not in offer and 'MODELO' in offer and 'VERSION' in offer:
-                    offer['full_name'] = offer['MODELO'].strip().upper() + " - " + offer['VERSION'].strip().upper()
-            for want in wants:
-                if 'full_name' not in want and 'MODELO' in want and 'VERSION' in want:
-                    want['full_name'] = want['MODELO'].strip().upper() + " - " + want['VERSION'].strip().upper()
-
-            requests.append({
-                'id': user['agency_id'],
-                'name': user.get('name', user['agency_id']),
-                'offers': offers,
-                'wants': wants,
-                'created_at': upload.get('uploaded_at', datetime.datetime.now()),
-                'status': 'pending'
-            })
+    # Only upload metadata goes through the pipeline; offers and wants are
+    # fetched per batch so no single document has to hold a whole upload.
+    uploads = list(mongo_collection.aggregate([
+        {"$unwind": "$uploads"},
+        {"$project": {
+            "_id": 0,
+            "agency_id": 1,
+            "name": 1,
+            "upload_id": "$uploads.upload_id",
+            # Uploads saved before offers/wants got their own collections
+            # still carry them inline.
+            "offers": "$uploads.offers",
+            "wants": "$uploads.wants",
+            "created_at": "$uploads.uploaded_at"
+        }}
+    ], allowDiskUse=False, batchSize=1000))
+    upload_ids = [upload['upload_id'] for upload in uploads if 'upload_id' in upload]
+    upload_offers = load_upload_items('offers', upload_ids)
+    upload_wants = load_upload_items('wants', upload_ids)
+
+    for upload in uploads:
+        upload_id = upload.get('upload_id')
+        offers = normalize_items(upload.get('offers', upload_offers.get(upload_id, [])))
+        wants = normalize_items(upload.get('wants', upload_wants.get(upload_id, [])))
+        for item in offers + wants:
+            item['_fid'] = intern_full_name(item['_fn'])
+
+        requests.append({
+            'id': upload['agency_id'],
+            'name': upload.get('name', upload['agency_id']),
+            'offers': offers,
+            'wants': wants,
+            'created_at': upload.get('created_at', datetime.datetime.now()),
+            'status': 'pending'
+        })
     return requests
 
+def item_columns(requests, field, node_ids):
+    owner = np.fromiter((node_ids[req['id']] for req in requests for _ in req[field]),
+                        dtype=np.int32)
+    fn = np.fromiter((item['_fid'] for req in requests for item in req[field]), dtype=np.int32)
+    return owner, fn
+
 def build_graph(requests):
     G = nx.DiGraph()
+    node_ids = {}
     for req in requests:
         G.add_node(req['id'])
-
-    for req_a in requests:
-        for req_b in requests:
-            if req_a['id'] == req_b['id']:
-                continue
-            if any(o['full_name'].lower() == w['full_name'].lower() for o in req_a['offers'] for w in req_b['wants']):
-                G.add_edge(req_a['id'], req_b['id'])
+        node_ids.setdefault(req['id'], len(node_ids))
+    nodes = list(node_ids)
+
+    # Offers and wants are flattened into parallel (owner, full_name id)
+    # columns so matching is a single hash join instead of nested loops.
+    offers_owner, offers_fn = item_columns(requests, 'offers', node_ids)
+    wants_owner, wants_fn = item_columns(requests, 'wants', node_ids)
+    offers_df = pd.DataFrame({
+        'a': offers_owner,
+        'fn': offers_fn,
+        'key': [offer['_fn'] for req in requests for offer in req['offers']],
+        'full_name': [offer['full_name'] for req in requests for offer in req['offers']]
+    })
+    wants_df = pd.DataFrame({'b': wants_owner, 'fn': wants_fn}).drop_duplicates()
+
+    edges_df = pd.merge(offers_df, wants_df, on='fn')
+    edges_df = edges_df[edges_df['a'] != edges_df['b']].drop_duplicates(['a', 'b', 'fn'])
+    edges_df = edges_df.sort_values(['a', 'b', 'key'])
+    offers = edges_df.groupby(['a', 'b'], sort=False)['full_name'].agg(list)
+    G.add_edges_from((nodes[a], nodes[b], {'offers': names}) for (a, b), names in offers.items())
     return G
 
-def violates_offer_conflict(cycle, request_map, used_offers):
-    for i in range(len(cycle) - 1):
-        giver_id = cycle[i]
-        receiver_id = cycle[i + 1]
-        giver = request_map[giver_id]
-        receiver = request_map[receiver_id]
-        for offer in giver['offers']:
-            for want in receiver['wants']:
-                if offer['full_name'].lower() == want['full_name'].lower():
-                    key = (giver_id, offer['full_name'])
-                    if key in used_offers:
-                        return True
-                    used_offers.add(key)
+def violates_offer_conflict(cycle, G, used_offers):
+    used_offers_add = used_offers.add
+    for giver_id, receiver_id in zip(cycle, cycle[1:]):
+        # Only the first matching offer is handed over, see describe_cycles.
+        key = (giver_id, G[giver_id][receiver_id]['offers'][0])
+        if key in used_offers:
+            return True
+        used_offers_add(key)
     return False
 
 def sample_cycles_greedy(G, request_map, max_len=10):
     all_cycles = []
-    used_nodes = set()
     used_offers = set()
 
-    for component in nx.connected_components(G.to_undirected()):
-        subgraph = G.subgraph(component).copy()
-        cycles = list(nx.simple_cycles(subgraph))
-        cycles = [c for c in cycles if len(c) >= 3 and c[0] == c[-1]]
-        cycles.sort(key=len, reverse=True)
-        for cycle in cycles:
-            if not any(node in used_nodes for node in cycle):
-                if not violates_offer_conflict(cycle, request_map, used_offers):
-                    all_cycles.append(cycle)
-                    used_nodes.update(cycle)
+    for component in nx.strongly_connected_components(G):
+        if len(component) < 3:
+            continue
+        # The DFS kernel stops at the first usable cycle through each still
+        # unused agency and prunes used ones, instead of enumerating every
+        # cycle of up to max_len nodes up front.
+        for cycle in enumerate_cycles_in_component(G, component, max_len):
+            if not violates_offer_conflict(cycle, G, used_offers):
+                all_cycles.append(cycle)
     return all_cycles
 
+@njit(cache=True, nogil=True)
+def dfs_cycles(indptr, indices, start, max_len, used):
+    # Cycles are returned flattened: cycle c is cycle_nodes[cycle_ends[c-1]:cycle_ends[c]].
+    # Only cycles through nodes not yet in used are returned, and their
+    # nodes are marked used before the search continues.
+    cycle_nodes = List.empty_list(types.int64)
+    cycle_ends = List.empty_list(types.int64)
+    if used[start]:
+        return cycle_nodes, cycle_ends
+
+    # path[:depth] is the path to the popped node. When a node at depth d is
+    # popped, every entry left on the stack is at depth <= d (never deeper),
+    # so writing path[d - 1] leaves path[:d - 1] holding its ancestors.
+    path = np.empty(max_len, dtype=np.int64)
+    stack_nodes = List.empty_list(types.int64)
+    stack_depths = List.empty_list(types.int64)
+    stack_nodes.append(start)
+    stack_depths.append(1)
+
+    while len(stack_nodes) > 0:
+        node = stack_nodes.pop()
+        depth = stack_depths.pop()
+        path[depth - 1] = node
+        # A path that picked up a used node can no longer close a usable cycle.
+        stale = False
+        for i in range(depth):
+            if used[path[i]]:
+                stale = True
+                break
+        if stale:
+            continue
+        for k in range(indptr[node], indptr[node + 1]):
+            neighbor = indices[k]
+            if neighbor == start and depth >= 3:
+                for i in range(depth):
+                    cycle_nodes.append(path[i])
+                    used[path[i]] = True
+                cycle_nodes.append(start)
+                cycle_ends.append(len(cycle_nodes))
+                break
+            elif depth < max_len and not used[neighbor]:
+                in_path = False
+                for i in range(depth):
+                    if path[i] == neighbor:
+                        in_path = True
+                        break
+                if not in_path:
+                    stack_nodes.append(neighbor)
+                    stack_depths.append(depth + 1)
+    return cycle_nodes, cycle_ends
+
+def to_csr(n, src, dst):
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int32)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst[order]
+
+def enumerate_cycles_in_component(G, component, max_len):
+    subgraph = G.subgraph(component)
+    nodes = list(subgraph)
+    node_ids = {node: idx for idx, node in enumerate(nodes)}
+    src = np.fromiter((node_ids[a] for a, _ in subgraph.edges), dtype=np.int32,
+                      count=subgraph.number_of_edges())
+    dst = np.fromiter((node_ids[b] for _, b in subgraph.edges), dtype=np.int32,
+                      count=subgraph.number_of_edges())
+    indptr, indices = to_csr(len(nodes), src, dst)
+
+    # Components are disjoint, so a per-component mask is enough to track
+    # used agencies; dfs_cycles updates it as it accepts cycles.
+    used = np.zeros(len(nodes), dtype=np.bool_)
+    cycles = []
+    for start in range(len(nodes)):
+        cycle_nodes, cycle_ends = dfs_cycles(indptr, indices, start, max_len, used)
+        begin = 0
+        for end in cycle_ends:
+            cycles.append([nodes[idx] for idx in cycle_nodes[begin:end]])
+            begin = end
+    return cycles
+
 def sample_cycles_exhaustive(G, request_map, max_len=10):
     all_cycles = []
-    used_nodes = set()
     used_offers = set()
 
-    for component in nx.connected_components(G.to_undirected()):
-        subgraph = G.subgraph(component).copy()
-        for start in subgraph.nodes:
-            stack = [(start, [start])]
-            while stack:
-                node, path = stack.pop()
-                for neighbor in subgraph.successors(node):
-                    if neighbor == start and len(path) >= 3:
-                        cycle = path + [start]
-                        if not any(p in used_nodes for p in cycle):
-                            if not violates_offer_conflict(cycle, request_map, used_offers):
-                                all_cycles.append(cycle)
-                                used_nodes.update(cycle)
-                        break
-                    elif neighbor not in path and len(path) < max_len:
-                        stack.append((neighbor, path + [neighbor]))
+    components = [c for c in nx.strongly_connected_components(G) if len(c) >= 3]
+    if not components:
+        return all_cycles
+
+    # dfs_cycles releases the GIL, so components are searched on threads;
+    # results come back in component order.
+    with ThreadPoolExecutor(max_workers=min(len(components), os.cpu_count() or 1)) as pool:
+        results = pool.map(lambda component: enumerate_cycles_in_component(G, component, max_len),
+                           components)
+        for cycles in results:
+            for cycle in cycles:
+                # Every giver in the cycle was unused, so none of its offers
+                # can be taken yet; this only records them.
+                if not violates_offer_conflict(cycle, G, used_offers):
+                    all_cycles.append(cycle)
     return all_cycles
 
-def describe_cycles(cycles, request_map):
+def describe_cycles(cycles, G, request_map):
     all_cycles = []
     user_cycles = []
 
@@ -151,11 +335,9 @@ def describe_cycles(cycles, request_map):
             receiver_id = cycle[i + 1]
             giver = request_map[giver_id]
             receiver = request_map[receiver_id]
-            matching_offer = next((o for o in giver['offers'] for w in receiver['wants']
-                                   if o['full_name'].lower() == w['full_name'].lower()), None)
-            if matching_offer:
-                line = f"{giver['name']} offers '{matching_offer['full_name']}' → to {receiver['name']}"
-                description.append(line)
+            matching_offer = G[giver_id][receiver_id]['offers'][0]
+            line = f"{giver['name']} offers '{matching_offer}' → to {receiver['name']}"
+            description.append(line)
 
         exchange_text = "\n".join(description)
         all_cycles.append({'cycle_id': cycle_id, 'exchange_path': exchange_text})
@@ -165,6 +347,38 @@ def describe_cycles(cycles, request_map):
 
     return pd.DataFrame(all_cycles), pd.DataFrame(user_cycles)
 
+def get_uploads_cache_key():
+    stats = next(mongo_collection.aggregate([
+        {"$group": {
+            "_id": None,
+            "n": {"$sum": {"$size": {"$ifNull": ["$uploads", []]}}},
+            "last": {"$max": {"$max": "$uploads.uploaded_at"}}
+        }}
+    ]), None)
+    return hashlib.md5(str(stats).encode()).hexdigest()
+
+@st.cache_data(ttl=300)
+def compute_cycles(algo_choice, cache_key):
+    all_requests = load_all_requests_from_mongo()
+    if not all_requests:
+        time.sleep(10)
+        all_requests = load_all_requests_from_mongo()
+
+    request_map = {r['id']: r for r in all_requests}
+    G = build_graph(all_requests)
+
+    if algo_choice == "Greedy (Efficient)":
+        cycles = sample_cycles_greedy(G, request_map)
+    else:
+        cycles = sample_cycles_exhaustive(G, request_map)
+
+    df_all, _ = describe_cycles(cycles, G, request_map)
+    return df_all
+
+@st.cache_data(ttl=300, max_entries=8)
+def to_csv_bytes(df):
+    return df.to_csv(index=False).encode()
+
 st.title("🚗 Car Exchange Platform")
 
 if mongo_collection is None:
@@ -182,9 +396,9 @@ if st.button("Upload File"):
     elif not user_file:
         st.error("Please select a file to upload.")
     else:
-        offers, wants = load_offer_want_excel(user_file)
-        save_user_data_to_mongo(offers, wants, name, agency_id)
-        st.success(f"Uploaded {len(offers)} offers and {len(wants)} wants.")
+        offers, wants = load_offer_want_excel(user_file.getvalue())
+        offers_stored, wants_stored = save_user_data_to_mongo(offers, wants, name, agency_id)
+        st.success(f"Uploaded {offers_stored} offers and {wants_stored} wants.")
         st.balloons()
 
 st.markdown("---")
@@ -193,27 +407,12 @@ st.header("🔄 Run Matching Across All Current Uploads")
 algo_choice = st.radio("Choose Cycle Detection Algorithm:", ["Greedy (Efficient)", "Exhaustive (Comprehensive)"])
 
 if st.button("🧮 Find Exchange Cycles"):
-    all_requests = load_all_requests_from_mongo()
-    if not all_requests:
-        time.sleep(10)
-        all_requests = load_all_requests_from_mongo()
-
-    request_map = {r['id']: r for r in all_requests}
-    G = build_graph(all_requests)
-
-    if algo_choice == "Greedy (Efficient)":
-        cycles = sample_cycles_greedy(G, request_map)
-    else:
-        cycles = sample_cycles_exhaustive(G, request_map)
-
-    df_all, _ = describe_cycles(cycles, request_map)
+    df_all = compute_cycles(algo_choice, get_uploads_cache_key())
 
     st.subheader("🔍 Exchange Cycles Preview")
     st.dataframe(df_all.head(10))
 
-    output = BytesIO()
-    df_all.to_csv(output, index=False)
-    st.download_button("📥 Download All Cycles", data=output.getvalue(), file_name="exchange_cycles.csv", mime="text/csv")
+    st.download_button("📥 Download All Cycles", data=to_csv_bytes(df_all), file_name="exchange_cycles.csv", mime="text/csv")
 
 st.markdown("---")
 with st.expander("⚠️ Danger Zone - Admin Only"):
@@ -221,6 +420,8 @@ with st.expander("⚠️ Danger Zone - Admin Only"):
     if st.button("🗑️ Clear All Uploads"):
         if password == "050699":
             mongo_collection.delete_many({})
+            mongo_collection.database.offers.delete_many({})
+            mongo_collection.database.wants.delete_many({})
             st.warning("All uploads have been cleared.")
         else:
             st.error("Incorrect password.")